@@ -4,26 +4,110 @@ Uses Groq API (free tier) or DeepSeek API for AI responses
 Works with Telegram Bot webhook
 """
 
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+import aiohttp
+import asyncio
+import bisect
+from async_lru import alru_cache
+import functools
 import httpx
+import logging
+import logging.handlers
+import orjson
 import os
-import tempfile
-from typing import List
+import queue
+from collections import deque
+from redis import asyncio as aioredis
+from contextlib import asynccontextmanager
+from typing import Deque, Optional
 from datetime import datetime
 
-app = FastAPI(title="Joy Girl API", version="4.1.0")
+# Log through a queue so stdout writes happen on a background thread
+# instead of blocking the event loop (Render captures stdout line-by-line)
+logger = logging.getLogger("joygirl")
+logger.setLevel(logging.WARNING)
 
-# Enable CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+def _setup_logging() -> logging.handlers.QueueListener:
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    return listener
+
+# Shared HTTP client - one pooled connection set for all outbound calls
+# instead of a new TCP + TLS handshake per request
+http_client: Optional[httpx.AsyncClient] = None
+# aiohttp session for the high-concurrency AI calls - it handles many
+# concurrent requests better than httpx
+ai_session: Optional[aiohttp.ClientSession] = None
+redis_client: Optional["aioredis.Redis"] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client, ai_session, redis_client
+    log_listener = _setup_logging()
+    # HTTP/2 multiplexes the notify + echo + webhook bursts that hit
+    # api.telegram.org within milliseconds of each other
+    http_client = httpx.AsyncClient(
+        timeout=30.0,
+        http2=True,
+        # 5 min keep-alive also amortizes DNS: a live connection never
+        # re-resolves api.telegram.org
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=50,
+            keepalive_expiry=300,
+        ),
+    )
+    ai_session = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=30),
+        connector=aiohttp.TCPConnector(
+            limit=100,
+            use_dns_cache=True,
+            ttl_dns_cache=300,
+            keepalive_timeout=300,
+        ),
+    )
+    if REDIS_URL:
+        redis_client = aioredis.from_url(REDIS_URL)
+    app.state.http = http_client
+    app.state.session = ai_session
+    app.state.redis = redis_client
+    yield
+    await http_client.aclose()
+    await ai_session.close()
+    if redis_client is not None:
+        await redis_client.aclose()
+        redis_client = None
+    http_client = None
+    ai_session = None
+    log_listener.stop()
+
+app = FastAPI(
+    title="Joy Girl API",
+    version="4.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
+# orjson serializes datetimes natively; render naive times as UTC with a Z
+ORJSON_OPTS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+def json_response(payload) -> Response:
+    """Serialize directly with orjson, skipping FastAPI's jsonable_encoder"""
+    return Response(
+        content=orjson.dumps(payload, option=ORJSON_OPTS),
+        media_type="application/json",
+    )
+
+# No CORS middleware: the ESP32 and Telegram talk to this API directly,
+# not from browser JavaScript, so every request was paying for headers
+# nothing consumes
+
 # Configuration - Try Groq first (free), fallback to DeepSeek
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
 GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.1-8b-instant")
@@ -35,15 +119,57 @@ DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "")
 
+# Optional Redis for shared state - required to run more than one uvicorn
+# worker, since the in-memory stores below are per-process
+REDIS_URL = os.getenv("REDIS_URL", "")
+MESSAGES_KEY = "joygirl:messages"
+WAITING_KEY = "joygirl:waiting"
+
 # Joy Girl personality
 JOY_GIRL_SYSTEM = """You are Joy Girl, a cheerful, friendly AI assistant.
 You live in a cute ESP32 device with a tiny OLED screen.
 Keep responses SHORT (under 40 words) - the screen is small!
 Be enthusiastic and helpful. Use emojis sometimes."""
 
+# Built once; every AI call reuses these instead of rebuilding the dicts
+SYS_MSG = {"role": "system", "content": JOY_GIRL_SYSTEM}
+GROQ_HEADERS = {
+    "Authorization": f"Bearer {GROQ_API_KEY}",
+    "Content-Type": "application/json"
+}
+DEEPSEEK_HEADERS = {
+    "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+    "Content-Type": "application/json"
+}
+
+def _body_template(model: str) -> bytes:
+    """Serialize the invariant request body once, with sentinels for the
+    per-call fields - building a body becomes two byte replaces"""
+    return orjson.dumps({
+        "model": model,
+        "messages": [SYS_MSG, {"role": "user", "content": "__JOY_PROMPT__"}],
+        "max_tokens": "__JOY_MAX_TOKENS__",
+        "temperature": 0.7
+    })
+
+GROQ_BODY_TMPL = _body_template(GROQ_MODEL)
+DEEPSEEK_BODY_TMPL = _body_template(DEEPSEEK_MODEL)
+
+def _ai_body(template: bytes, prompt: str, max_tokens: int) -> bytes:
+    # max_tokens first, prompt last: orjson.dumps(prompt) yields a quoted,
+    # escaped JSON string, and substituting it last means no later replace
+    # can ever touch user-controlled bytes
+    return template.replace(b'"__JOY_MAX_TOKENS__"', str(max_tokens).encode()) \
+                   .replace(b'"__JOY_PROMPT__"', orjson.dumps(prompt))
+
 # Store recent messages for ESP32
-recent_messages: List[dict] = []
+# message_ids mirrors recent_messages; Telegram ids are monotonic, so it
+# stays sorted and since_id lookups can binary-search instead of scanning
 MAX_MESSAGES = 20
+recent_messages: Deque[dict] = deque(maxlen=MAX_MESSAGES)
+message_ids: Deque[int] = deque(maxlen=MAX_MESSAGES)
+# Bumped on every append so cached /messages responses invalidate themselves
+messages_version = 0
 notification_sent_time = None
 waiting_for_reply = False
 
@@ -51,83 +177,87 @@ class ChatRequest(BaseModel):
     message: str
     max_tokens: int = 60
 
+class AIUnavailableError(Exception):
+    """No provider returned an answer; raised (not returned) so the
+    response cache never stores a failure"""
+
 async def get_ai_response(prompt: str, max_tokens: int = 60) -> str:
-    """Get response from Groq API (free) or DeepSeek API"""
-    
-    # Try Groq first (free tier)
+    """Get response from Groq API (free) or DeepSeek API.
+
+    Identical prompts within the TTL are answered from cache - the
+    personality is the same for every user, so the key is just the
+    stripped prompt. Only successes are cached; failures retry on the
+    next call.
+    """
+    try:
+        return await _fetch_ai_response(prompt.strip(), max_tokens)
+    except AIUnavailableError as e:
+        return str(e)
+
+async def _groq_call(prompt: str, max_tokens: int) -> Optional[str]:
+    try:
+        async with ai_session.post(
+            "https://api.groq.com/openai/v1/chat/completions",
+            headers=GROQ_HEADERS,
+            data=_ai_body(GROQ_BODY_TMPL, prompt, max_tokens)
+        ) as response:
+            if response.status == 200:
+                data = await response.json()
+                return data["choices"][0]["message"]["content"].strip()
+            logger.warning("Groq error: %s - %s", response.status, await response.text())
+    except Exception as e:
+        logger.warning("Groq error: %s", e)
+    return None
+
+async def _deepseek_call(prompt: str, max_tokens: int) -> Optional[str]:
+    try:
+        async with ai_session.post(
+            "https://api.deepseek.com/v1/chat/completions",
+            headers=DEEPSEEK_HEADERS,
+            data=_ai_body(DEEPSEEK_BODY_TMPL, prompt, max_tokens)
+        ) as response:
+            if response.status == 200:
+                data = await response.json()
+                return data["choices"][0]["message"]["content"].strip()
+            logger.warning("DeepSeek error: %s - %s", response.status, await response.text())
+    except Exception as e:
+        logger.warning("DeepSeek error: %s", e)
+    return None
+
+@alru_cache(maxsize=256, ttl=300)
+async def _fetch_ai_response(prompt: str, max_tokens: int) -> str:
+    # Hedge: fire every configured provider at once and take the first
+    # good answer, instead of waiting 30s for Groq before trying DeepSeek
+    tasks = []
     if GROQ_API_KEY:
-        try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    "https://api.groq.com/openai/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {GROQ_API_KEY}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": GROQ_MODEL,
-                        "messages": [
-                            {"role": "system", "content": JOY_GIRL_SYSTEM},
-                            {"role": "user", "content": prompt}
-                        ],
-                        "max_tokens": max_tokens,
-                        "temperature": 0.7
-                    }
-                )
-
-                if response.status_code == 200:
-                    data = response.json()
-                    return data["choices"][0]["message"]["content"].strip()
-                else:
-                    print(f"Groq error: {response.status_code} - {response.text}")
-        except Exception as e:
-            print(f"Groq error: {e}")
-    
-    # Fallback to DeepSeek
+        tasks.append(asyncio.create_task(_groq_call(prompt, max_tokens)))
     if DEEPSEEK_API_KEY:
-        try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    "https://api.deepseek.com/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": DEEPSEEK_MODEL,
-                        "messages": [
-                            {"role": "system", "content": JOY_GIRL_SYSTEM},
-                            {"role": "user", "content": prompt}
-                        ],
-                        "max_tokens": max_tokens,
-                        "temperature": 0.7
-                    }
-                )
-
-                if response.status_code == 200:
-                    data = response.json()
-                    return data["choices"][0]["message"]["content"].strip()
-                else:
-                    print(f"DeepSeek error: {response.status_code} - {response.text}")
-                    return "Sorry, my brain glitched!"
-        except Exception as e:
-            print(f"DeepSeek error: {e}")
-            return "Oops! Connection error!"
-    
-    return "Error: No AI API key configured!"
+        tasks.append(asyncio.create_task(_deepseek_call(prompt, max_tokens)))
+    if not tasks:
+        raise AIUnavailableError("Error: No AI API key configured!")
+
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            result = task.result()
+            if result is not None:
+                for loser in pending:
+                    loser.cancel()
+                return result
+    raise AIUnavailableError("Sorry, my brain glitched!")
 
 async def send_telegram_message(chat_id: str, text: str):
     if not TELEGRAM_BOT_TOKEN:
         return False
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.post(
-                f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-                json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
-            )
-            return response.status_code == 200
-        except:
-            return False
+    try:
+        response = await http_client.post(
+            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
+            json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
+        )
+        return response.status_code == 200
+    except:
+        return False
 
 @app.get("/")
 async def root():
@@ -136,7 +266,7 @@ async def root():
 
 @app.get("/health")
 async def health():
-    return {"status": "healthy"}
+    return json_response({"status": "healthy"})
 
 @app.post("/telegram/notify")
 async def send_notification():
@@ -151,16 +281,18 @@ Reply to this message to chat!
     if success:
         notification_sent_time = datetime.now()
         waiting_for_reply = True
+        if redis_client is not None:
+            await redis_client.set(WAITING_KEY, "1", ex=300)
         return {"ok": True, "message": "Notification sent!"}
     return {"ok": False, "error": "Failed to send"}
 
 @app.post("/telegram/webhook")
 async def telegram_webhook(request: Request):
-    global waiting_for_reply
+    global waiting_for_reply, messages_version
     try:
-        update = await request.json()
+        update = orjson.loads(await request.body())
         if "message" not in update:
-            return {"status": "ignored"}
+            return json_response({"status": "ignored"})
 
         message = update["message"]
         chat_id = str(message["chat"]["id"])
@@ -171,53 +303,85 @@ async def telegram_webhook(request: Request):
         if "text" in message:
             user_text = message["text"]
             if user_text.startswith("/"):
-                return {"status": "command"}
+                return json_response({"status": "command"})
         else:
-            return {"status": "unsupported"}
+            return json_response({"status": "unsupported"})
 
         joy_girl_response = await get_ai_response(user_text)
-        await send_telegram_message(chat_id, f"🌸 {joy_girl_response}")
+        # Let the Telegram echo fly while we store the message; awaited
+        # again below so failures still surface before we return
+        send_task = asyncio.create_task(
+            send_telegram_message(chat_id, f"🌸 {joy_girl_response}")
+        )
 
         msg = {
             "id": message_id,
             "text": user_text,
             "from_user": from_user,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": datetime.now(),
             "response": joy_girl_response
         }
-        recent_messages.append(msg)
-        if len(recent_messages) > MAX_MESSAGES:
-            recent_messages.pop(0)
+        if redis_client is not None:
+            # Sorted set scored by message_id keeps since_id range reads cheap
+            pipe = redis_client.pipeline()
+            pipe.zadd(MESSAGES_KEY, {orjson.dumps(msg, option=ORJSON_OPTS): message_id})
+            pipe.zremrangebyrank(MESSAGES_KEY, 0, -(MAX_MESSAGES + 1))
+            pipe.delete(WAITING_KEY)
+            await pipe.execute()
+        else:
+            # maxlen makes append + evict O(1); no manual pop needed
+            recent_messages.append(msg)
+            message_ids.append(message_id)
+            messages_version += 1
         waiting_for_reply = False
-        return {"status": "ok", "response": joy_girl_response}
+        await send_task
+        return json_response({"status": "ok", "response": joy_girl_response})
     except Exception as e:
-        print(f"Webhook error: {e}")
-        return {"status": "error", "detail": str(e)}
+        logger.warning("Webhook error: %s", e)
+        return json_response({"status": "error", "detail": str(e)})
+
+@functools.lru_cache(maxsize=128)
+def _render_messages(version: int, since_id: int, limit: int) -> bytes:
+    """Filter + serialize once per (version, since_id, limit); polls hit the cache"""
+    idx = bisect.bisect_right(message_ids, since_id)
+    messages = list(recent_messages)[idx:][-limit:]
+    return orjson.dumps({"messages": messages, "count": len(messages)}, option=ORJSON_OPTS)
 
 @app.get("/messages")
 async def get_messages(limit: int = 5, since_id: int = 0):
-    filtered = [m for m in recent_messages if m["id"] > since_id]
-    messages = filtered[-limit:] if filtered else []
-    return {"messages": messages, "count": len(messages)}
+    # Clamp so limit<=0 behaves identically on both storage paths
+    # (the in-memory [-0:] slice used to return everything)
+    limit = max(limit, 1)
+    if redis_client is not None:
+        # Shared store: the set is capped at MAX_MESSAGES, so reading the
+        # full since_id range and slicing the tail is cheap
+        raw = await redis_client.zrangebyscore(MESSAGES_KEY, f"({since_id}", "+inf")
+        messages = [orjson.loads(m) for m in raw[-limit:]]
+        return json_response({"messages": messages, "count": len(messages)})
+    return Response(
+        content=_render_messages(messages_version, since_id, limit),
+        media_type="application/json",
+    )
 
 @app.get("/telegram/setWebhook")
 async def set_webhook(webhook_url: str):
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook",
-            json={"url": webhook_url}
-        )
-        return response.json()
+    response = await http_client.post(
+        f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook",
+        json={"url": webhook_url}
+    )
+    return response.json()
 
 @app.get("/telegram/webhookInfo")
 async def get_webhook_info():
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.get(
-            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getWebhookInfo"
-        )
-        return response.json()
+    response = await http_client.get(
+        f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getWebhookInfo"
+    )
+    return response.json()
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 10000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # More than one worker needs REDIS_URL so all workers share state
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run("app:app", host="0.0.0.0", port=port, loop="uvloop", http="httptools",
+                workers=workers)